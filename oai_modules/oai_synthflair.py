@@ -15,22 +15,36 @@ from PIL import ImageDraw
 import orthanc
 import io
 import json
-from tools import add_text_to_dicom, rename_series
+from tools import add_text_to_dicom, rename_series, acquire_model, release_model, SeriesIndex
 
 class SynthFlair():
     def __init__(self, config):
         self.config = config
         if self.config["synthflair_generator_path"]:
-            self.synthflair_generator = tf.keras.models.load_model(self.config["synthflair_generator_path"])
+            self.synthflair_generator = acquire_model(self.config["synthflair_generator_path"], tf.keras.models.load_model)
         else:
             self.synthflair_generator = None
-        if self.config["syntht2eg_generator_path"]:
-            self.syntht2eg_generator = tf.keras.models.load_model(self.config["syntht2eg_generator_path"])
-        else:
-            self.syntht2eg_generator = None
-
-    def process(self, files, source_aet):
-        origFiles, b0, b1000, adc, mask, minb1000, maxb1000 = self.processDWI(files)
+        try:
+            if self.config["syntht2eg_generator_path"]:
+                self.syntht2eg_generator = acquire_model(self.config["syntht2eg_generator_path"], tf.keras.models.load_model)
+            else:
+                self.syntht2eg_generator = None
+        except Exception:
+            # no instance will exist, so unload will never be called: we release the first model now
+            release_model(self.synthflair_generator)
+            raise
+
+    def unload(self):
+        # models are shared between modules and reloads: we only release them
+        release_model(self.synthflair_generator)
+        release_model(self.syntht2eg_generator)
+        self.synthflair_generator = None
+        self.syntht2eg_generator = None
+
+    def process(self, files, source_aet, series_index=None):
+        if series_index is None:
+            series_index = SeriesIndex(files)
+        origFiles, b0, b1000, adc, mask, minb1000, maxb1000 = self.processDWI(series_index)
         returnFiles = []
         if self.synthflair_generator is not None:
             returnFiles += self.createSynthFlairFiles(origFiles, b0, b1000, adc, mask, minb1000, maxb1000)
@@ -68,29 +82,14 @@ class SynthFlair():
                     padvol[ivol] = padvol[ivol][:,cuty1:-cuty2,:]
         return tuple(padvol)
 
-    def processDWI(self, files):
-        slices = []
-        for f in files:
-            if hasattr(f, 'SliceLocation'):
-                slices.append(f)
-        b0 = []
-        b1000 = []
-        for s in slices:
-            if str(s[0x0043, 0x1039][0]) == "0":
-                b0.append(s)
-            if "1000" in str(s[0x0043, 0x1039][0]):
-                b1000.append(s)
-        b0 = sorted(b0, key=lambda s: s.SliceLocation)
-        b1000 = sorted(b1000, key=lambda s: s.SliceLocation)
-
-        orig_shape = (b0[0].pixel_array.shape) + (len(b0),)
-        b0_src = np.zeros(orig_shape)
-        for i, s in enumerate(b0):
-            orig_dtype = s.pixel_array.dtype
-            b0_src[:,:,i] = s.pixel_array
-        b1000_src = np.zeros(orig_shape)
-        for i, s in enumerate(b1000):
-            b1000_src[:,:,i] = s.pixel_array
+    def processDWI(self, series_index):
+        # slices are already sorted and grouped by b-value in the series index
+        # files without SliceLocation (e.g. derived images) are not used
+        b0 = [s for s in series_index.group("BValue", 0) if hasattr(s, 'SliceLocation')]
+        b1000 = [s for s in series_index.group("BValue", 1000) if hasattr(s, 'SliceLocation')]
+
+        b0_src = series_index.stack(b0)
+        b1000_src = series_index.stack(b1000)
 
         b0_padded, b1000_padded = self.padvol([b0_src, b1000_src], 256, 256)
 
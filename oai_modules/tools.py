@@ -3,10 +3,18 @@ from pydicom.uid import RLELossless
 import hashlib
 import re
 import json
+import os
+import sys
+import time
+import threading
+import cProfile
+import tracemalloc
+from collections import Counter, OrderedDict
 from io import BytesIO
 import orthanc
 from PIL import Image, ImageDraw, ImageFont
 import pydicom
+import pydicom.multival
 
 ###################### GENERAL PURPOSE TOOLS ######################
 
@@ -41,6 +49,203 @@ def flatten(mylist):
                 yield i
     return list(flatten_gen(mylist))
 
+###################### MODEL REGISTRY ######################
+
+# model_fingerprint : cheap fingerprint of a model file or folder (SavedModel), based on sizes and modification times
+def model_fingerprint(path):
+    if os.path.isdir(path):
+        entries = []
+        for root, dirs, filenames in os.walk(path):
+            dirs.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(root, filename)
+                stat = os.stat(filepath)
+                entries.append(os.path.relpath(filepath, path) + ":" + str(stat.st_size) + ":" + str(stat.st_mtime_ns))
+    else:
+        stat = os.stat(path)
+        entries = [str(stat.st_size) + ":" + str(stat.st_mtime_ns)]
+    return hashlib.md5("\n".join(entries).encode()).hexdigest()
+
+# ModelRegistry : process-wide cache of loaded models, keyed by model path and fingerprint
+# Models are reference counted, unused models are kept (up to max_unused, least recently used evicted first)
+# so that a module reload or several modules using the same model do not load the weights again
+class ModelRegistry():
+    def __init__(self, max_unused=2):
+        self.max_unused = max_unused
+        self.models = {} # (path, fingerprint) -> [model, refcount]
+        self.unused = OrderedDict() # (path, fingerprint) of unused models, least recently used first
+        self.loading = {} # (path, fingerprint) -> threading.Event of models being loaded
+        self.lock = threading.RLock()
+
+    def acquire(self, path, loader):
+        # sends back the model stored at path, loading it with loader(path) only if necessary
+        path = os.path.realpath(path)
+        key = (path, model_fingerprint(path))
+        while True:
+            with self.lock:
+                if key in self.models.keys():
+                    self.models[key][1] += 1
+                    self.unused.pop(key, None)
+                    return self.models[key][0]
+                if key not in self.loading.keys():
+                    # we are in charge of loading this model
+                    loaded_event = threading.Event()
+                    self.loading[key] = loaded_event
+                    break
+                loaded_event = self.loading[key]
+            # another thread is loading the same model: we wait for it (and retry if its loading failed)
+            loaded_event.wait()
+        # loading is done outside the lock, so that it does not block other models acquire/release
+        try:
+            model = loader(path)
+        except Exception:
+            with self.lock:
+                del self.loading[key]
+            loaded_event.set()
+            raise
+        with self.lock:
+            # outdated versions of the same model are useless once unused
+            for outdated in [k for k in self.unused.keys() if k[0] == path]:
+                self.evict(outdated)
+            self.models[key] = [model, 1]
+            del self.loading[key]
+        loaded_event.set()
+        orthanc.LogWarning("Model registry : loaded ``" + path + "``")
+        return model
+
+    def release(self, model):
+        # releases a model previously obtained with acquire
+        with self.lock:
+            for key, entry in self.models.items():
+                if entry[0] is model:
+                    entry[1] -= 1
+                    if entry[1] <= 0:
+                        entry[1] = 0
+                        if any(k[0] == key[0] and k != key for k in self.models.keys()):
+                            # a newer version of this model is loaded: the outdated one is not cached
+                            del self.models[key]
+                            orthanc.LogWarning("Model registry : evicted ``" + key[0] + "``")
+                        else:
+                            self.unused[key] = True
+                            self.unused.move_to_end(key)
+                    break
+            self.trim()
+
+    def evict(self, key):
+        del self.models[key]
+        del self.unused[key]
+        orthanc.LogWarning("Model registry : evicted ``" + key[0] + "``")
+
+    def trim(self):
+        # evicts least recently used unused models above max_unused
+        with self.lock:
+            while len(self.unused) > max(self.max_unused, 0):
+                self.evict(next(iter(self.unused)))
+
+    def set_max_unused(self, max_unused):
+        with self.lock:
+            self.max_unused = max_unused
+            self.trim()
+
+model_registry = ModelRegistry()
+
+# acquire_model : gets a shared model from the registry, loader(path) is only called if it is not already loaded
+def acquire_model(path, loader):
+    return model_registry.acquire(path, loader)
+
+# release_model : releases a model obtained with acquire_model (should be called in the module `unload`)
+def release_model(model):
+    if model is not None:
+        model_registry.release(model)
+
+###################### PROFILING TOOLS ######################
+
+profiling_modes = {"cProfile": "prof", "tracemalloc": "txt", "sampling": "txt"}
+
+# StackSampler : periodically samples the stack of one thread and counts the collapsed stacks
+class StackSampler():
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.counts = Counter()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code.co_filename + ":" + frame.f_code.co_name + ":" + str(frame.f_lineno))
+                frame = frame.f_back
+            if len(stack) > 0:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def dump(self, output_path):
+        # collapsed stacks format, can be read by flamegraph.pl or speedscope
+        with open(output_path, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write(stack + " " + str(count) + "\n")
+
+# profile_call : calls func(*args) under the given profiling mode and writes the result in output_folder
+# sends back the return value of func and the path of the written profile
+def profile_call(func, args, mode, output_folder, label="call", interval=0.005):
+    if mode == "sampling" and interval <= 0:
+        raise Exception("Profiling sampling interval should be positive")
+    if mode not in profiling_modes.keys():
+        raise Exception("Unknown profiling mode `" + str(mode) + "`, should be one of " + ", ".join(profiling_modes.keys()))
+    os.makedirs(output_folder, exist_ok=True)
+    output_path = os.path.join(output_folder, label + "_" + mode + "_" + time.strftime("%Y%m%d-%H%M%S") + \
+                               "_" + str(int(time.time()*1000) % 1000).zfill(3) + "." + profiling_modes[mode])
+    try:
+        if mode == "cProfile":
+            profiler = cProfile.Profile()
+            try:
+                result = profiler.runcall(func, *args)
+            finally:
+                profiler.dump_stats(output_path)
+        elif mode == "tracemalloc":
+            already_tracing = tracemalloc.is_tracing()
+            if not already_tracing:
+                tracemalloc.start(1) # allocations are only grouped by line
+            # only the allocations of this call are reported
+            tracemalloc.reset_peak()
+            current_before = tracemalloc.get_traced_memory()[0]
+            snapshot_before = tracemalloc.take_snapshot()
+            try:
+                result = func(*args)
+            finally:
+                current, peak = tracemalloc.get_traced_memory()
+                snapshot_after = tracemalloc.take_snapshot()
+                if not already_tracing:
+                    tracemalloc.stop()
+                with open(output_path, "w") as f:
+                    f.write("Retained after call: " + str(current - current_before) + " B, " + \
+                            "Peak during call: " + str(peak - current_before) + " B\n")
+                    for stat in snapshot_after.compare_to(snapshot_before, "lineno")[:100]:
+                        f.write(str(stat) + "\n")
+        else:
+            sampler = StackSampler(interval)
+            sampler.start()
+            try:
+                result = func(*args)
+            finally:
+                sampler.stop()
+                sampler.dump(output_path)
+    finally:
+        # logged even if func raises, the profile of a failing call is also written
+        orthanc.LogWarning("Profile of `" + label + "` written in " + output_path)
+    return result, output_path
+
 ###################### DICOM SENDING TOOLS ######################
 
 # pushes an array of file to an orthanc destination
@@ -64,6 +269,144 @@ def push_instances_to(instances, destination):
     orthanc.RestApiPost("/modalities/" + destination + "/store", postString)
 
 
+###################### DICOM INDEXING TOOLS ######################
+
+index_groupings = ["BValue", "EchoNumbers", "TemporalPositionIdentifier"]
+
+# dicom_int : parses a dicom value as an integer (first value if multi-valued), or None if it cannot be parsed
+def dicom_int(value):
+    if isinstance(value, bytes):
+        value = value.decode(errors="ignore").strip("\x00 ").split("\\")
+    if isinstance(value, (list, tuple, pydicom.multival.MultiValue)):
+        if len(value) == 0:
+            return None
+        value = value[0]
+    if value is None or value == "":
+        return None
+    try:
+        return int(float(value))
+    except (ValueError, TypeError):
+        return None
+
+# dicom_bvalue : sends back the diffusion b-value of a dicom file (standard, GE or Siemens tag), or None
+def dicom_bvalue(dcmfile):
+    for tag in [(0x0018, 0x9087), (0x0043, 0x1039), (0x0019, 0x100c)]:
+        element = dcmfile.get(tag)
+        if element is None:
+            continue
+        value = dicom_int(element.value)
+        if value is not None:
+            # GE may add 1e9 to the b-value
+            return value % 100000
+    return None
+
+# SeriesIndex : sorts the files of a series once and groups them by b-value, echo and temporal position
+# slices are sorted by position along the slice normal (ImagePositionPatient), then by InstanceNumber
+class SeriesIndex():
+    def __init__(self, dcmfiles):
+        self.files = list(dcmfiles)
+        self.geometry = {}
+        self.groups = {grouping: {} for grouping in index_groupings}
+        self.slices = []
+        self.slice_positions = [] # position along the slice normal of each slice (None if unknown)
+        if len(self.files) == 0:
+            return
+        # geometry is taken from the first file with an orientation
+        normal = None
+        for f in self.files:
+            orientation = f.get("ImageOrientationPatient")
+            if orientation is not None and len(orientation) == 6:
+                orientation = np.array(orientation, dtype=float)
+                normal = np.cross(orientation[:3], orientation[3:])
+                self.geometry["ImageOrientationPatient"] = orientation
+                self.geometry["Normal"] = normal
+                break
+        first = self.files[0]
+        self.geometry["Rows"] = first.get("Rows")
+        self.geometry["Columns"] = first.get("Columns")
+        if first.get("PixelSpacing") is not None:
+            self.geometry["PixelSpacing"] = np.array(first.PixelSpacing, dtype=float)
+        # attributes are read only once per file
+        keys = []
+        file_positions = []
+        for i, f in enumerate(self.files):
+            position = None
+            ipp = f.get("ImagePositionPatient")
+            if normal is not None and ipp is not None and len(ipp) == 3:
+                try:
+                    position = float(np.dot(np.array(ipp, dtype=float), normal))
+                except (ValueError, TypeError):
+                    position = None
+            file_positions.append(position)
+            instance_number = dicom_int(f.get("InstanceNumber"))
+            keys.append((position if position is not None else np.inf,
+                         instance_number if instance_number is not None else 0, i))
+            values = {"BValue": dicom_bvalue(f), "EchoNumbers": dicom_int(f.get("EchoNumbers")),
+                      "TemporalPositionIdentifier": dicom_int(f.get("TemporalPositionIdentifier"))}
+            for grouping in index_groupings:
+                if values[grouping] is not None:
+                    self.groups[grouping].setdefault(values[grouping], []).append(i)
+        order = [k[2] for k in sorted(keys)]
+        rank = {i: r for r, i in enumerate(order)}
+        self.slices = [self.files[i] for i in order]
+        self.slice_positions = [file_positions[i] for i in order]
+        for grouping in index_groupings:
+            for value in self.groups[grouping].keys():
+                self.groups[grouping][value] = [self.files[i] for i in sorted(self.groups[grouping][value], key=rank.get)]
+        self.update_slice_spacing()
+
+    def update_slice_spacing(self):
+        positions = np.array([p for p in self.slice_positions if p is not None])
+        self.geometry.pop("SliceSpacing", None)
+        if len(positions) > 1:
+            steps = np.diff(np.unique(positions))
+            if len(steps) > 0: self.geometry["SliceSpacing"] = float(np.median(steps))
+
+    def group(self, grouping, value):
+        # sorted slices for a value of a grouping (e.g. group("BValue", 1000)), empty list if absent
+        return self.groups[grouping].get(value, [])
+
+    def positions(self, dcmfiles):
+        # positions along the slice normal of a list of files from this index
+        slice_positions = {id(f): p for f, p in zip(self.slices, self.slice_positions)}
+        return np.array([slice_positions[id(f)] for f in dcmfiles if slice_positions.get(id(f)) is not None])
+
+    @staticmethod
+    def stack(dcmfiles, dtype=float):
+        # stacks the pixel arrays of a list of files as a (rows, columns, slices) volume
+        if len(dcmfiles) == 0:
+            return np.zeros((0, 0, 0), dtype)
+        shape = dcmfiles[0].pixel_array.shape
+        volume = np.zeros(shape + (len(dcmfiles),), dtype)
+        for i, f in enumerate(dcmfiles):
+            pixel_array = f.pixel_array
+            if pixel_array.shape != shape:
+                raise Exception("Cannot stack slice " + str(i) + " of shape " + str(pixel_array.shape) + \
+                                " with slices of shape " + str(shape))
+            volume[:,:,i] = pixel_array
+        return volume
+
+    def subset(self, dcmfiles):
+        # index of a subset of the files (e.g. after module filters), reusing this index if nothing was removed
+        # otherwise, sorted slices and groups are only filtered (no attribute is read again)
+        if len(dcmfiles) == len(self.files):
+            return self
+        members = set(id(f) for f in dcmfiles)
+        index = SeriesIndex([])
+        index.files = list(dcmfiles)
+        index.geometry = dict(self.geometry)
+        for f, p in zip(self.slices, self.slice_positions):
+            if id(f) in members:
+                index.slices.append(f)
+                index.slice_positions.append(p)
+        for grouping in index_groupings:
+            for value, group in self.groups[grouping].items():
+                group = [f for f in group if id(f) in members]
+                if len(group) > 0:
+                    index.groups[grouping][value] = group
+        index.update_slice_spacing()
+        return index
+
 ###################### DICOM MANIPULATION TOOLS ######################
 
 # Takes a PILImage, converts it to a JPEG format and stores it in a dcmfile
@@ -7,6 +7,7 @@ import re
 import glob
 import orthanc
 import importlib.util, sys
+import inspect
 import traceback
 from pydicom import dcmread
 from io import BytesIO
@@ -15,7 +16,8 @@ from multiprocessing import Pool
 
 # In order to allow tools loading from inside modules, we add the "oai_modules" directory to the path
 sys.path.append(os.path.join(os.path.dirname(__file__), "oai_modules"))
-from tools import md5_file, clean_json, dir_public_attributes, flatten, push_files_to
+from tools import md5_file, clean_json, dir_public_attributes, flatten, push_files_to, profile_call, profiling_modes, \
+                  model_registry, SeriesIndex
 
 ## ABSOLUTE path for Orthanc AI
 config_path = __file__.replace(".py",".json")
@@ -27,6 +29,8 @@ authorized_triggers = ["Patient","Series","Study"]
 list_filters = ["AccessionNumber","PatientName","PatientID","StudyDescription","SeriesDescription","ImageType",
                 "InstitutionName", "InstitutionalDepartmentName", "Manufacturer", "ManufacturerModelName",
                 "Modality", "OperatorsName", "PerformingPhysicianName", "ProtocolName", "StudyID"]
+profiling_callback_target = "safe_callback"
+stable_change_types = [orthanc.ChangeType.STABLE_PATIENT, orthanc.ChangeType.STABLE_STUDY, orthanc.ChangeType.STABLE_SERIES]
 
 
 class OrthancAI():
@@ -41,6 +45,14 @@ class OrthancAI():
         self.Timer = None
         self.LockTimer = True
         self.Pool = None
+        # on-demand profiling state, profiling_calls = 0 means profiling is off
+        self.profiling_target = None
+        self.profiling_mode = None
+        self.profiling_calls = 0
+        self.profiling_interval = 0.005
+        self.profiling_folder = os.path.join(self.root_folder, "profiles")
+        self.profiling_lock = threading.Lock()
+        self.profiling_config = None # last `Profiling` block applied from the configuration file
         try:
             self.update_architecture() # Main subroutine for config loading and modules loading
         except Exception as e:
@@ -120,6 +132,12 @@ class OrthancAI():
             self.check_mandatory_parameters(mandatory_parameters, temporary_config)
             self.main_config = temporary_config
             self.main_config_md5 = config_md5
+            model_registry.set_max_unused(int(self.main_config.get("ModelCacheSize", 2)))
+            # the `Profiling` block is only applied when it has changed, so that unrelated edits of the
+            # configuration neither cancel profiling armed through REST API nor arm it again
+            if "Profiling" in self.main_config.keys() and self.main_config["Profiling"] != self.profiling_config:
+                self.configure_profiling(self.main_config["Profiling"], from_config=True)
+                self.profiling_config = self.main_config["Profiling"]
             if self.config["MultiprocessModules"]:
                 self.Pool = Pool(self.config["MultiprocessModules"])
             else:
@@ -128,10 +146,98 @@ class OrthancAI():
         # load or reload modules
         self.module_crawler()
 
+    def configure_profiling(self, settings, from_config=False):
+        # arms profiling for the next `Calls` calls of `Target` (a module id or "safe_callback")
+        if type(settings) is not dict:
+            raise Exception("`Profiling` parameter should be a dictionary")
+        calls = int(settings.get("Calls", 0))
+        if calls > 0:
+            if "Target" not in settings.keys() or type(settings["Target"]) is not str:
+                raise Exception("Please specify the profiling `Target` (module id or `" + profiling_callback_target + "`)")
+            if settings.get("Mode", "cProfile") not in profiling_modes.keys():
+                raise Exception("Invalid profiling `Mode`, should be one of " + ", ".join(profiling_modes.keys()))
+        if "SamplingInterval" in settings.keys() and not float(settings["SamplingInterval"]) > 0:
+            raise Exception("Invalid profiling `SamplingInterval`, should be positive")
+        with self.profiling_lock:
+            if from_config and "OutputFolder" in settings.keys():
+                # output folder can only be set from the configuration file, not from the REST API
+                self.profiling_folder = os.path.join(self.root_folder, settings["OutputFolder"])
+            if "SamplingInterval" in settings.keys():
+                self.profiling_interval = float(settings["SamplingInterval"])
+            self.profiling_target = settings.get("Target", None)
+            self.profiling_mode = settings.get("Mode", "cProfile")
+            self.profiling_calls = max(calls, 0)
+        if self.profiling_calls > 0:
+            orthanc.LogWarning("Profiling `" + self.profiling_target + "` with " + self.profiling_mode + \
+                               " for the next " + str(self.profiling_calls) + " calls")
+
+    def profiling_status(self):
+        # sends back the profiling state and the list of available profiles
+        profiles = []
+        if os.path.isdir(self.profiling_folder):
+            profiles = sorted(os.listdir(self.profiling_folder))
+        return {"Target": self.profiling_target, "Mode": self.profiling_mode, "Calls": self.profiling_calls,
+                "SamplingInterval": self.profiling_interval, "Profiles": profiles}
+
+    def profiled_call(self, target, func, args, counted=None):
+        # calls func(*args), under profiling if `target` is armed
+        # if counted(result) is False, the profile is discarded and the call is given back
+        with self.profiling_lock:
+            armed = self.profiling_calls > 0 and self.profiling_target == target
+            if armed:
+                self.profiling_calls -= 1
+                mode = self.profiling_mode
+        if not armed:
+            return func(*args)
+        result, output_path = profile_call(func, args, mode, self.profiling_folder, target, self.profiling_interval)
+        if counted is not None and not counted(result):
+            os.remove(output_path)
+            orthanc.LogWarning("Profile of `" + target + "` discarded, no module was called")
+            with self.profiling_lock:
+                if self.profiling_target == target and self.profiling_mode == mode:
+                    self.profiling_calls += 1
+        return result
+
+    def rest_profiling(self, output, uri, **request):
+        # REST callback : GET for status or profile download, POST for arming profiling, DELETE for disarming
+        try:
+            groups = request.get("groups", ())
+            profile_name = groups[0] if len(groups) > 0 else ""
+            if request["method"] == "GET" and profile_name:
+                # download a profile (only files present in the profiling folder can be accessed)
+                profile_name = os.path.basename(profile_name)
+                profile_path = os.path.join(self.profiling_folder, profile_name)
+                if not os.path.isfile(profile_path):
+                    output.SendHttpStatusCode(404)
+                    return
+                with open(profile_path, "rb") as f:
+                    output.AnswerBuffer(f.read(), "application/octet-stream")
+                return
+            elif profile_name:
+                output.SendMethodNotAllowed("GET")
+                return
+            elif request["method"] == "POST":
+                self.configure_profiling(json.loads(request["body"]))
+            elif request["method"] == "DELETE":
+                self.configure_profiling({"Calls": 0})
+            elif request["method"] != "GET":
+                output.SendMethodNotAllowed("GET,POST,DELETE")
+                return
+            output.AnswerBuffer(json.dumps(self.profiling_status(), indent=2), "application/json")
+        except Exception as e:
+            orthanc.LogWarning("Error during profiling request : " + str(e))
+            output.SendHttpStatusCode(400)
+
     def callback(self, changeType, level, resourceId):
         # main callback function called by orthanc API when events are triggered
         try:
-            self.safe_callback(changeType, level, resourceId) # encapsulated into a try/except for safety
+            # encapsulated into a try/except for safety
+            if self.profiling_calls > 0 and changeType in stable_change_types:
+                # only callbacks which have dispatched files to modules are counted
+                self.profiled_call(profiling_callback_target, self.safe_callback, (changeType, level, resourceId),
+                                   counted=bool)
+            else:
+                self.safe_callback(changeType, level, resourceId)
         except Exception as e:
             orthanc.LogWarning("Error during loading callback : " + str(e))
             print(traceback.format_exc())
@@ -160,6 +266,7 @@ class OrthancAI():
             return # other event, not supported
 
         self.LockTimer = True # prevent any module loading during callback
+        dispatched = False # sent back to tell if files were dispatched to modules
         print("Callback `" + changeType + "` with instance : " + resourceId)
 
         # update the OrthancAI architecture, if needed
@@ -216,6 +323,8 @@ class OrthancAI():
                             f = orthanc.GetDicomForInstance(instanceId)
                             dc = dcmread(BytesIO(f))
                             allfiles[st][se].append(dc)
+                # series indexes are built once per event (only if a module uses them) and shared between modules
+                allindexes = {}
                 # then, we check each module compatible with the trigger type
                 if self.Pool is not None:
                     list_calls = []
@@ -231,25 +340,54 @@ class OrthancAI():
                                     if module.apply_filters(im):
                                         # for each file and module, we check if it matches the Positive and Negative filters
                                         files[st][se].append(im)
+                        # create recursive array of series indexes, with the same structure as files
+                        indexes = None
+                        if module.accepts_series_index:
+                            indexes = []
+                            for st in range(len(files)):
+                                indexes.append([])
+                                for se in range(len(files[st])):
+                                    indexes[st].append(None)
+                                    if len(files[st][se]) > 0:
+                                        # full series index is built once, modules with filters get a subset of it
+                                        if (st, se) not in allindexes.keys():
+                                            try:
+                                                allindexes[(st, se)] = SeriesIndex(allfiles[st][se])
+                                            except Exception as e:
+                                                orthanc.LogWarning("Error during series indexing : " + str(e))
+                                                print(traceback.format_exc())
+                                                allindexes[(st, se)] = None
+                                        if allindexes[(st, se)] is not None:
+                                            indexes[st][se] = allindexes[(st, se)].subset(files[st][se])
                         # clean up empty arrays if necessary
                         for st in reversed(range(len(files))):
                             for se in reversed(range(len(files[st]))):
-                                if len(files[st][se]) == 0: del files[st][se]
-                            if len(files[st]) == 0: del files[st]
+                                if len(files[st][se]) == 0:
+                                    del files[st][se]
+                                    if indexes is not None: del indexes[st][se]
+                            if len(files[st]) == 0:
+                                del files[st]
+                                if indexes is not None: del indexes[st]
                         if len(files) > 0:
                             # format the files array in the correct shape
-                            if changeType == "Study": files = files[0]
-                            if changeType == "Series": files = files[0][0]
+                            if changeType == "Study":
+                                files = files[0]
+                                if indexes is not None: indexes = indexes[0]
+                            if changeType == "Series":
+                                files = files[0][0]
+                                if indexes is not None: indexes = indexes[0][0]
                             if self.Pool is not None:
-                                list_calls += [(module.module_id, files, metadata["RemoteAET"])]
+                                list_calls += [(module.module_id, files, metadata["RemoteAET"], indexes)]
                                 all_destinations += [module.config["DestinationName"]]
                             else:
                                 # send the filtered files to the module
-                                processed_files = self.process((module.module_id, files, metadata["RemoteAET"]))
+                                dispatched = True
+                                processed_files = self.process((module.module_id, files, metadata["RemoteAET"], indexes))
                                 if processed_files and processed_files is not None:
                                     # if the module has returned files, we push them to DICOM server
                                     self.push_files(processed_files, module.config["DestinationName"])
             if self.Pool is not None and len(list_calls) > 0:
+                dispatched = True
                 all_processed_files = p.map(self.process, list_calls)
                 for i in range(len(all_processed_files)):
                     processed_files = all_processed_files[i]
@@ -260,13 +398,16 @@ class OrthancAI():
             if changeType == "Patient" and self.main_config["AutoRemove"]:
                 self.cleanup_instances(externalInstances)
         self.LockTimer = False # free auto-reloading
+        return dispatched
 
     def process(self, list_args):
         try:
-            module_id, files, remote_aet = list_args
+            module_id, files, remote_aet, series_index = list_args
             orthanc.LogWarning("Calling `" + module_id + "` " + \
                             " with " + str(len(files)) + " files")
-            return self.modules_list[module_id].process(files, remote_aet)
+            if self.profiling_calls > 0:
+                return self.profiled_call(module_id, self.modules_list[module_id].process, (files, remote_aet, series_index))
+            return self.modules_list[module_id].process(files, remote_aet, series_index)
         except Exception as e:
             orthanc.LogWarning("Error during module `" + module_id + "` processing : " + str(e))
             print(traceback.format_exc())
@@ -300,6 +441,7 @@ class OrthancAIModule():
         self.module_lib = None
         self.module_class = None
         self.module_instance = None
+        self.accepts_series_index = False
         # load config and module
         self.load_config()
 
@@ -337,6 +479,8 @@ class OrthancAIModule():
         self.module_class = getattr(self.module_lib, self.config["ClassName"])
         # we call the __init__ subroutine of the loaded module
         self.module_instance = self.module_class(self.config)
+        # modules whose process subroutine has a `series_index` parameter receive the prebuilt series indexes
+        self.accepts_series_index = "series_index" in inspect.signature(self.module_instance.process).parameters
         orthanc.LogWarning("Loaded module ``" + self.module_id + "``")
         self.loaded = True
 
@@ -344,6 +488,7 @@ class OrthancAIModule():
         # subroutine called to check if there is config or python update
         if self.config_md5 != md5_file(self.config_path):
             # config change : we reload config and module
+            self.unload_instance()
             del self.module_lib, self.module_class, self.module_instance, self.config
             self.module_md5 = None
             self.config_md5 = None
@@ -352,12 +497,22 @@ class OrthancAIModule():
             self.load_config()
         elif self.module_md5 != md5_file(self.module_path):
             # python change : we reload only the module
+            self.unload_instance()
             del self.module_lib, self.module_class, self.module_instance
             self.module_md5 = None
             self.loaded = False
             orthanc.LogWarning("Reloading module `" + self.module_id + "`...")
             self.load_module()
 
+    def unload_instance(self):
+        # calls the optional `unload` subroutine of the module, allowing to release shared models
+        if self.module_instance is not None and hasattr(self.module_instance, "unload"):
+            try:
+                self.module_instance.unload()
+            except Exception as e:
+                orthanc.LogWarning("Error during unloading module `" + self.module_id + "` : " + str(e))
+                print(traceback.format_exc())
+
     def apply_filters(self, file):
         # Subroutine called by the main OrthancAI callback to check if each file may be sent to the module
         # First we have a look at the positive filters
@@ -389,9 +544,11 @@ class OrthancAIModule():
                                 return False
         return True
 
-    def process(self, files, remote_aet):
+    def process(self, files, remote_aet, series_index=None):
         # Calling the module process subroutine
         if self.module_instance is not None:
+            if self.accepts_series_index:
+                return self.module_instance.process(files, remote_aet, series_index=series_index)
             return self.module_instance.process(files, remote_aet)
         else:
             return []
@@ -403,4 +560,6 @@ class OrthancAIModule():
 # Creation of OrthancAI
 oia = OrthancAI(config_path)
 # registering triggers
-orthanc.RegisterOnChangeCallback(oia.callback)
\ No newline at end of file
+orthanc.RegisterOnChangeCallback(oia.callback)
+orthanc.RegisterRestCallback("/orthanc-ai/profiling", oia.rest_profiling)
+orthanc.RegisterRestCallback("/orthanc-ai/profiling/(.*)", oia.rest_profiling)
\ No newline at end of file